@@ -1,49 +1,133 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
-from pymongo import MongoClient, monitoring
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
 from bson.objectid import ObjectId
 import os
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 from datetime import datetime
 import logging
 from functools import wraps
 import warnings
-import logging
+import click
 import requests
 import json
 import threading
 from time import sleep
 from bson import json_util
+from flask_caching import Cache
+from flask_session import Session
+import redis
 
-# Disable PyMongo debug logs
+# Disable PyMongo debug logs, including its command, server and connection loggers
 logging.getLogger('pymongo').setLevel(logging.WARNING)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
 warnings.filterwarnings("ignore", category=UserWarning, module='pymongo')
 
-# Disable command monitoring logs
-monitoring._COMMAND_LOGGER = None
-monitoring._SERVER_LOGGER = None
-monitoring._TOPOLOGY_LOGGER = None
-monitoring._CONNECTION_LOGGER = None
-
 app = Flask(__name__)
 app.secret_key =  os.getenv('SECRET_KEY')  
 MONGO_URL = os.getenv('MONGO_URL')
+REDIS_URL = os.getenv('REDIS_URL')
+
+# Shared page cache; Redis when available so all workers see the same entries
+cache = Cache(app, config={
+    'CACHE_TYPE': 'RedisCache' if REDIS_URL else 'SimpleCache',
+    'CACHE_REDIS_URL': REDIS_URL,
+    'CACHE_DEFAULT_TIMEOUT': 5
+})
+
+# Keep sessions in Redis so the cookie only carries a session id
+if REDIS_URL:
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_PERMANENT'] = False  # Keep browser-session cookies like Flask's default
+    app.config['SESSION_REDIS'] = redis.Redis.from_url(REDIS_URL)
+    Session(app)
+
+# Give the session a new id when its owner changes, so a server-side session id
+# obtained before login can't be planted in a victim's browser and reused
+def rotate_session():
+    if REDIS_URL:
+        app.session_interface.regenerate(session)
 
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper())
 logger = logging.getLogger(__name__)
 
+# Case-insensitive comparison for tag prefix search
+TAGS_COLLATION = {'locale': 'en', 'strength': 2}
+
+# Indexes for the fields the routes filter and sort on. Each one is created on its own
+# so a failure (e.g. duplicates blocking a unique index) doesn't skip the rest.
+def ensure_indexes():
+    # Check the server is reachable once rather than waiting out the timeout per index
+    try:
+        client.admin.command('ping')
+    except Exception:
+        logger.warning("MongoDB unreachable, skipping index creation")
+        return
+
+    indexes = [
+        (users_collection, 'username', {'unique': True}),
+        (users_collection, 'email', {'unique': True}),
+        (questions_collection, [('created_at', -1), ('_id', -1)], {}),
+        (questions_collection, 'user_id', {}),
+        (questions_collection, 'tags', {'name': 'tags_ci', 'collation': TAGS_COLLATION}),  # Prefix search
+        (questions_collection, [('title', 'text'), ('content', 'text'), ('tags', 'text')], {}),
+        (answers_collection, [('question_id', 1), ('is_ai', 1), ('votes', -1)], {}),  # Covers view_question's sort
+        (answers_collection, 'user_id', {}),
+    ]
+    for collection, keys, options in indexes:
+        try:
+            collection.create_index(keys, **options)
+        except Exception:
+            logger.exception("Failed to create index %s on %s", keys, collection.name)
+
 
 try:
-    client = MongoClient(MONGO_URL)
+    # One pooled client for the whole process; every collection below shares it
+    client = MongoClient(
+        MONGO_URL,
+        maxPoolSize=20,
+        minPoolSize=2,
+        maxIdleTimeMS=60_000,
+        serverSelectionTimeoutMS=3000,
+        compressors='zstd,zlib',
+        retryWrites=True,
+        appname='askup'
+    )
     db = client.askup
     users_collection = db.users
     questions_collection = db.questions
     answers_collection = db.answers
+    ensure_indexes()
 except Exception as e:
     print(f"Database connection error: {e}")
 
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=2)
+
+# Check a password against a user's stored hash, upgrading legacy werkzeug hashes to argon2
+def verify_password(user, password):
+    stored_hash = user['password']
+    if stored_hash.startswith('$argon2'):
+        try:
+            password_hasher.verify(stored_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        needs_rehash = password_hasher.check_needs_rehash(stored_hash)
+    else:
+        if not check_password_hash(stored_hash, password):
+            return False
+        needs_rehash = True
+
+    if needs_rehash:
+        users_collection.update_one(
+            {'_id': user['_id']},
+            {'$set': {'password': password_hasher.hash(password)}}
+        )
+    return True
+
 # Authentication decorator
 def login_required(f):
     @wraps(f)
@@ -53,24 +137,97 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-# Helper function to get current user
+# Helper function to get the logged in user's id as an ObjectId, parsed once per request
+def get_current_user_id():
+    if 'user_id' not in g:
+        g.user_id = ObjectId(session['user_id']) if 'user_id' in session else None
+    return g.user_id
+
+# Helper function to get current user; the username is kept in the session so
+# pages that only render it don't need a database query
 def get_current_user():
-    if 'user_id' in session:
-        return users_collection.find_one({'_id': ObjectId(session['user_id'])})
-    return None
+    if 'user' not in g:
+        user_id = get_current_user_id()
+        if not user_id:
+            g.user = None
+        elif 'username' in session:
+            g.user = {'_id': user_id, 'username': session['username']}
+        else:
+            # Session from before usernames were stored in it
+            g.user = users_collection.find_one({'_id': user_id}, {'_id': 1, 'username': 1})
+            if g.user:
+                session['username'] = g.user['username']
+    return g.user
+
+# Fields question listings render; content is cut down to what the preview shows
+QUESTION_LIST_FIELDS = {
+    'title': 1,
+    'tags': 1,
+    'created_at': 1,
+    'user_id': 1,
+    'votes': 1,
+    'answer_count': 1,
+    'content': {'$substrCP': ['$content', 0, 201]}
+}
+
+# Aggregation stages that attach the author's username to each document
+def author_lookup_stages():
+    return [
+        {'$lookup': {
+            'from': 'users',
+            'let': {'uid': '$user_id'},
+            'pipeline': [
+                {'$match': {'$expr': {'$eq': ['$_id', '$$uid']}}},
+                {'$project': {'username': 1}}
+            ],
+            'as': 'author'
+        }},
+        {'$addFields': {
+            'username': {'$ifNull': [{'$arrayElemAt': ['$author.username', 0]}, 'Anonymous']}
+        }},
+        {'$project': {'author': 0}}
+    ]
+
+QUESTIONS_PER_PAGE = 20
+
+# Only anonymous first pages without pending flash messages are safe to share between visitors
+def is_personalized():
+    return 'user_id' in session or '_flashes' in session or 'after' in request.args
 
 @app.route('/')
+@cache.cached(timeout=5, key_prefix='index', unless=is_personalized)
 def index():
-    questions = list(questions_collection.find().sort('created_at', -1).limit(20))
+    # Keyset pagination: ?after=<created_at>_<id> of the last question on the previous page
+    match = {}
+    after = request.args.get('after')
+    if after:
+        try:
+            created_at, last_id = after.rsplit('_', 1)
+            created_at, last_id = datetime.fromisoformat(created_at), ObjectId(last_id)
+        except Exception:
+            flash('Invalid page')
+            return redirect(url_for('index'))
+        match = {'$or': [
+            {'created_at': {'$lt': created_at}},
+            {'created_at': created_at, '_id': {'$lt': last_id}}
+        ]}
+
+    # Sort and limit before joining so the lookups only touch the page being rendered
+    questions = list(questions_collection.aggregate([
+        {'$match': match},
+        {'$sort': {'created_at': -1, '_id': -1}},
+        {'$limit': QUESTIONS_PER_PAGE + 1},  # One extra row tells us whether there's a next page
+        {'$project': QUESTION_LIST_FIELDS},
+        *author_lookup_stages()
+    ]))
     
-    # Get answer counts for each question
-    for question in questions:
-        question['answer_count'] = answers_collection.count_documents({'question_id': question['_id']})
-        # Get user info
-        user = users_collection.find_one({'_id': ObjectId(question['user_id'])})
-        question['username'] = user['username'] if user else 'Anonymous'
+    next_after = None
+    if len(questions) > QUESTIONS_PER_PAGE:
+        questions = questions[:QUESTIONS_PER_PAGE]
+        last = questions[-1]
+        next_after = f"{last['created_at'].isoformat()}_{last['_id']}"
     
-    return render_template('index.html', questions=questions, current_user=get_current_user())
+    return render_template('index.html', questions=questions, next_after=next_after, current_user=get_current_user())
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -79,21 +236,28 @@ def register():
         email = request.form['email']
         password = request.form['password']
         
-        # Check if user already exists
-        if users_collection.find_one({'$or': [{'username': username}, {'email': email}]}):
+        # Check if user already exists before paying for the password hash
+        if users_collection.find_one({'$or': [{'username': username}, {'email': email}]}, {'_id': 1}):
             flash('Username or email already exists')
             return redirect(url_for('register'))
         
         # Create new user
-        hashed_password = generate_password_hash(password)
-        user_id = users_collection.insert_one({
-            'username': username,
-            'email': email,
-            'password': hashed_password,
-            'created_at': datetime.utcnow()
-        }).inserted_id
+        hashed_password = password_hasher.hash(password)
+        try:
+            user_id = users_collection.insert_one({
+                'username': username,
+                'email': email,
+                'password': hashed_password,
+                'created_at': datetime.utcnow()
+            }).inserted_id
+        except DuplicateKeyError:
+            # A concurrent registration took the username or email after the check above
+            flash('Username or email already exists')
+            return redirect(url_for('register'))
         
+        rotate_session()
         session['user_id'] = str(user_id)
+        session['username'] = username
         flash('Registration successful!')
         return redirect(url_for('index'))
     
@@ -107,8 +271,10 @@ def login():
         
         user = users_collection.find_one({'username': username})
         
-        if user and check_password_hash(user['password'], password):
+        if user and verify_password(user, password):
+            rotate_session()
             session['user_id'] = str(user['_id'])
+            session['username'] = user['username']
             flash('Login successful!')
             return redirect(url_for('index'))
         else:
@@ -118,7 +284,8 @@ def login():
 
 @app.route('/logout')
 def logout():
-    session.pop('user_id', None)
+    session.clear()
+    rotate_session()
     flash('You have been logged out')
     return redirect(url_for('index'))
 
@@ -174,7 +341,7 @@ def generate_ai_answer(question_id, question_title, question_content):
             # Update question to indicate it has an AI answer
             questions_collection.update_one(
                 {'_id': question_id},
-                {'$set': {'has_ai_answer': True}}
+                {'$set': {'has_ai_answer': True}, '$inc': {'answer_count': 1}}
             )
             
         except Exception as e:
@@ -199,16 +366,18 @@ def ask_question():
             'title': title,
             'content': content,
             'tags': tags,
-            'user_id': ObjectId(session['user_id']),
+            'user_id': get_current_user_id(),
             'created_at': datetime.utcnow(),
             'votes': 0,
             'voted_by': [],
             'allow_ai_answers': allow_ai_answers,
-            'has_ai_answer': False
+            'has_ai_answer': False,
+            'answer_count': 0
         }
         
         result = questions_collection.insert_one(question)
         question_id = result.inserted_id
+        cache.delete('index')
         
         # If AI answers are allowed, start background task to generate answer
         if allow_ai_answers:
@@ -234,32 +403,30 @@ def view_question(question_id):
 
     try:
         obj_id = ObjectId(question_id)
-        question = questions_collection.find_one({'_id': obj_id})
+
+        # Fetch the question together with its author
+        question = next(questions_collection.aggregate([
+            {'$match': {'_id': obj_id}},
+            {'$limit': 1},
+            *author_lookup_stages(),
+            {'$project': {'voted_by': 0}}
+        ]), None)
 
         if not question:
             flash('Question not found')
             return redirect(url_for('index'))
 
-        # Attach question author
-        user_id = question.get('user_id')
-        if user_id and ObjectId.is_valid(user_id):
-            author = users_collection.find_one({'_id': ObjectId(user_id)})
-            question['username'] = author['username'] if author else 'Anonymous'
-        else:
-            question['username'] = 'Anonymous'
-
-        # Fetch answers and authors
-        answers = list(answers_collection.find({'question_id': obj_id}).sort([('is_ai', 1), ('votes', -1)]))  # Sort AI answers first, then by votes
-        for answer in answers:
-            if answer.get('is_ai'):
-                answer['username'] = 'AI Assistant'
-            else:
-                user_id = answer.get('user_id')
-                if user_id and ObjectId.is_valid(user_id):
-                    author = users_collection.find_one({'_id': ObjectId(user_id)})
-                    answer['username'] = author['username'] if author else 'Anonymous'
-                else:
-                    answer['username'] = 'Anonymous'
+        # Answers are a separate query: embedding them in the question's result document
+        # would put the whole page under MongoDB's 16 MB document limit
+        answers = list(answers_collection.aggregate([
+            {'$match': {'question_id': obj_id}},
+            {'$sort': {'is_ai': 1, 'votes': -1}},
+            *author_lookup_stages(),
+            {'$addFields': {
+                'username': {'$cond': ['$is_ai', 'AI Assistant', '$username']}
+            }},
+            {'$project': {'voted_by': 0}}
+        ]))
 
         return render_template('question.html', 
                                question=question, 
@@ -277,14 +444,19 @@ def post_answer(question_id):
     content = request.form['content']
     
     try:
+        obj_id = ObjectId(question_id)
         answers_collection.insert_one({
             'content': content,
-            'question_id': ObjectId(question_id),
-            'user_id': ObjectId(session['user_id']),
+            'question_id': obj_id,
+            'user_id': get_current_user_id(),
             'created_at': datetime.utcnow(),
             'votes': 0,
             'voted_by': []
         })
+        questions_collection.update_one(
+            {'_id': obj_id},
+            {'$inc': {'answer_count': 1}}
+        )
         
         flash('Answer posted successfully!')
     except Exception as e:
@@ -296,40 +468,43 @@ def post_answer(question_id):
 @login_required
 def vote(item_type, item_id, vote_type):
     try:
-        collection = questions_collection if item_type == 'question' else answers_collection
-        item = collection.find_one({'_id': ObjectId(item_id)})
+        if vote_type not in ('up', 'down'):
+            return jsonify({'error': 'Invalid vote type'}), 400
         
-        if not item:
-            return jsonify({'error': 'Item not found'}), 404
-        
-        user_id = ObjectId(session['user_id'])
-        voted_by = item.get('voted_by', [])
-        current_votes = item.get('votes', 0)
-        
-        # Check if user already voted
-        user_vote = next((vote for vote in voted_by if vote['user_id'] == user_id), None)
+        collection = questions_collection if item_type == 'question' else answers_collection
+        item_id = ObjectId(item_id)
+        user_id = get_current_user_id()
+        delta = 1 if vote_type == 'up' else -1
         
-        if user_vote:
-            # User already voted, update or remove vote
-            if user_vote['type'] == vote_type:
-                # Same vote type, remove vote
-                voted_by = [vote for vote in voted_by if vote['user_id'] != user_id]
-                current_votes -= 1 if vote_type == 'up' else -1
-            else:
-                # Different vote type, change vote
-                user_vote['type'] = vote_type
-                current_votes += 2 if vote_type == 'up' else -2
-        else:
+        # Each update only matches in the matching voting state, so the first one that
+        # modifies the document wins and concurrent votes can't overwrite each other
+        updates = [
             # New vote
-            voted_by.append({'user_id': user_id, 'type': vote_type})
-            current_votes += 1 if vote_type == 'up' else -1
+            ({'_id': item_id, 'voted_by.user_id': {'$ne': user_id}},
+             {'$push': {'voted_by': {'user_id': user_id, 'type': vote_type}}, '$inc': {'votes': delta}}),
+            # Different vote type, change vote
+            ({'_id': item_id, 'voted_by': {'$elemMatch': {'user_id': user_id, 'type': {'$ne': vote_type}}}},
+             {'$set': {'voted_by.$.type': vote_type}, '$inc': {'votes': 2 * delta}}),
+            # Same vote type, remove vote
+            ({'_id': item_id, 'voted_by': {'$elemMatch': {'user_id': user_id, 'type': vote_type}}},
+             {'$pull': {'voted_by': {'user_id': user_id}}, '$inc': {'votes': -delta}}),
+        ]
+        for query, update in updates:
+            item = collection.find_one_and_update(
+                query,
+                update,
+                projection={'votes': 1},
+                return_document=ReturnDocument.AFTER
+            )
+            if item:
+                return jsonify({'votes': item['votes']})
         
-        collection.update_one(
-            {'_id': ObjectId(item_id)},
-            {'$set': {'votes': current_votes, 'voted_by': voted_by}}
-        )
+        # No update matched, either the item doesn't exist or another vote raced this one
+        item = collection.find_one({'_id': item_id}, {'votes': 1})
+        if not item:
+            return jsonify({'error': 'Item not found'}), 404
         
-        return jsonify({'votes': current_votes})
+        return jsonify({'votes': item.get('votes', 0)})
     
     except Exception as e:
         return jsonify({'error': 'Voting failed'}), 500
@@ -337,18 +512,35 @@ def vote(item_type, item_id, vote_type):
 @app.route('/profile/<username>')
 def profile(username):
 
-    user = users_collection.find_one({'username': username})
+    user = users_collection.find_one({'username': username}, {'username': 1, 'email': 1, 'created_at': 1})
     if not user:
         flash('User not found')
         return redirect(url_for('index'))
     
-    user_questions = list(questions_collection.find({'user_id': user['_id']}).sort('created_at', -1))
-    user_answers = list(answers_collection.find({'user_id': user['_id']}).sort('created_at', -1))
+    user_questions = list(questions_collection.find(
+        {'user_id': user['_id']},
+        {'title': 1, 'created_at': 1, 'votes': 1}
+    ).sort('created_at', -1))
     
-    # Get question titles for answers
-    for answer in user_answers:
-        question = questions_collection.find_one({'_id': answer['question_id']})
-        answer['question_title'] = question['title'] if question else 'Unknown Question'
+    # Get question titles for answers in the same query
+    user_answers = list(answers_collection.aggregate([
+        {'$match': {'user_id': user['_id']}},
+        {'$sort': {'created_at': -1}},
+        {'$project': {'question_id': 1, 'created_at': 1, 'votes': 1}},
+        {'$lookup': {
+            'from': 'questions',
+            'let': {'qid': '$question_id'},
+            'pipeline': [
+                {'$match': {'$expr': {'$eq': ['$_id', '$$qid']}}},
+                {'$project': {'title': 1}}
+            ],
+            'as': 'question'
+        }},
+        {'$addFields': {
+            'question_title': {'$ifNull': [{'$arrayElemAt': ['$question.title', 0]}, 'Unknown Question']}
+        }},
+        {'$project': {'question': 0}}
+    ]))
     
     return render_template('profile.html', 
                          user=user, 
@@ -360,21 +552,23 @@ def profile(username):
 @login_required
 def delete_question(question_id):
     try:
-        question = questions_collection.find_one({'_id': ObjectId(question_id)})
+        obj_id = ObjectId(question_id)
+        question = questions_collection.find_one({'_id': obj_id}, {'user_id': 1})
         
         # Check if question exists and user is the owner
         if not question:
             flash('Question not found')
             return redirect(url_for('index'))
             
-        if str(question['user_id']) != session['user_id']:
+        if question['user_id'] != get_current_user_id():
             flash('You can only delete your own questions')
             return redirect(url_for('view_question', question_id=question_id))
             
         # Delete all answers first
-        answers_collection.delete_many({'question_id': ObjectId(question_id)})
+        answers_collection.delete_many({'question_id': obj_id})
         # Then delete the question
-        questions_collection.delete_one({'_id': ObjectId(question_id)})
+        questions_collection.delete_one({'_id': obj_id})
+        cache.delete('index')
         
         flash('Question and its answers have been deleted')
         return redirect(url_for('index'))
@@ -384,28 +578,64 @@ def delete_question(question_id):
         flash('An error occurred while deleting the question')
         return redirect(url_for('index'))
 
+SEARCH_RESULTS_LIMIT = 50
+
 @app.route('/search')
 def search():
     query = request.args.get('q', '')
-    if query:
-        # Simple text search in questions
-        questions = list(questions_collection.find({
-            '$or': [
-                {'title': {'$regex': query, '$options': 'i'}},
-                {'content': {'$regex': query, '$options': 'i'}},
-                {'tags': {'$in': [query]}}
+    prefix = query.rstrip('*').strip()
+    if prefix:
+        if query.endswith('*'):
+            # Prefix search ("pyth*") isn't supported by the text index, so it matches tags
+            # only: a case-insensitive range on the collated tags index. U+FFFF sorts after
+            # every other character, which makes it the upper bound for the prefix.
+            match_stages = [
+                {'$match': {'tags': {'$elemMatch': {'$gte': prefix, '$lt': prefix + '\uffff'}}}},
+                {'$sort': {'created_at': -1}}
             ]
-        }).sort('created_at', -1))
-        
-        # Get answer counts and usernames
-        for question in questions:
-            question['answer_count'] = answers_collection.count_documents({'question_id': question['_id']})
-            user = users_collection.find_one({'_id': ObjectId(question['user_id'])})
-            question['username'] = user['username'] if user else 'Anonymous'
+            options = {'collation': TAGS_COLLATION}
+        else:
+            # Full text search in questions, best matches first
+            match_stages = [
+                {'$match': {'$text': {'$search': query}}},
+                {'$sort': {'score': {'$meta': 'textScore'}, 'created_at': -1}}
+            ]
+            options = {}
+
+        # Join usernames onto the matches
+        questions = list(questions_collection.aggregate([
+            *match_stages,
+            {'$limit': SEARCH_RESULTS_LIMIT + 1},  # One extra row tells us the results were cut off
+            {'$project': QUESTION_LIST_FIELDS},
+            *author_lookup_stages()
+        ], **options))
     else:
         questions = []
     
-    return render_template('search.html', questions=questions, query=query, current_user=get_current_user())
+    more_results = len(questions) > SEARCH_RESULTS_LIMIT
+    questions = questions[:SEARCH_RESULTS_LIMIT]
+    
+    return render_template('search.html', questions=questions, more_results=more_results, query=query, current_user=get_current_user())
+
+@app.cli.command('backfill-answer-counts')
+def backfill_answer_counts():
+    """One-time backfill of answer_count for questions created before it was stored"""
+    counts = {doc['_id']: doc['n'] for doc in answers_collection.aggregate([
+        {'$group': {'_id': '$question_id', 'n': {'$sum': 1}}}
+    ])}
+    updated = 0
+    batch = []
+    for question in questions_collection.find({}, {'_id': 1}):
+        batch.append(UpdateOne(
+            {'_id': question['_id']},
+            {'$set': {'answer_count': counts.get(question['_id'], 0)}}
+        ))
+        if len(batch) == 1000:
+            updated += questions_collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += questions_collection.bulk_write(batch, ordered=False).modified_count
+    click.echo(f"Updated answer_count on {updated} questions")
 
 if __name__ == '__main__':
     import os